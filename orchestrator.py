@@ -29,33 +29,300 @@ Usage:
         --task "Deploy new n8n workflow"
 """
 
+import contextlib
+import copy
+import functools
+import gzip
+import hashlib
+import os
+import re
+import shlex
+import shutil
+import signal
 import subprocess
 import json
 import sys
-import yaml
-import requests
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from datetime import datetime
-from typing import Optional, List, Union
+from fnmatch import fnmatch
+from typing import TYPE_CHECKING, Callable, Optional, List, Tuple
+
+if TYPE_CHECKING:
+    import requests
+    from teacher import TeacherLLM
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson parses webhook responses several times faster when installed
+json_loads = orjson.loads if orjson else json.loads
 
 # Default n8n webhook URL - used if teacher mode is "webhook"
 DEFAULT_N8N_WEBHOOK_URL = "https://im4tlai.app.n8n.cloud/webhook/prompt-learning-teacher"
 
-# Windows shell handling
+# Bytecode cache for test runs. Kept outside the project so that `git add .`
+# never picks it up and `git reset --hard` never discards it, and per user
+# (not in the shared temp dir) so nobody else can plant .pyc files in it.
+PYCACHE_PREFIX = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") \
+    / "prompt-learning" / "pycache"
+
+# Section of CLAUDE.md that learned rules are appended under
+LEARNED_SECTION_HEADER = "## Learned Rules & Patterns"
+
+# Number of recent rule hashes remembered for duplicate detection
+RULE_HASH_LIMIT = 1000
+
+# Metadata line added under each learned rule by append_rule()
+RULE_SOURCE_RE = re.compile(r"^\s*- \*\*Source\*\*:.*\n?", re.MULTILINE)
+
+# Paths that only contain tests; changes limited to these teach no rule
+TEST_PATH_RE = re.compile(r"(^|/)tests?/|(^|/)test_[^/]*\.py$|_test\.py$")
+
+# pytest options whose value is the next argument; an existing path there is
+# that option's value, not a test path to replace when sharding
+PYTEST_VALUE_OPTIONS = frozenset({
+    "-c", "--config-file", "--rootdir", "--basetemp", "--confcutdir",
+    "-p", "-o", "--override-ini", "--ignore", "--ignore-glob", "--deselect",
+    "--junitxml", "--junit-xml", "--log-file", "--json-report-file",
+    "--cov", "--cov-config", "--cov-report", "-k", "-m", "-W",
+})
+
+# Output kept from streamed subprocesses (Claude Code, pytest)
+STREAM_TAIL_CHARS = 64 * 1024
+# Longest piece of a line read at once from a streamed subprocess
+STREAM_CHUNK_CHARS = 8 * 1024
+# Wait for output after a streamed subprocess exits before killing what it
+# left running with the pipe still open
+STREAM_DRAIN_SECONDS = 5
+# Leading output kept from test runs (session header, collection errors)
+TEST_HEAD_CHARS = 8 * 1024
+
+# Merged configs keyed by (resolved path, mtime, size), shared by all loop instances
+_CONFIG_CACHE = {}
+
+# ANSI color escape sequences (e.g. from pytest --color=yes)
+ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+# Start of a pytest report section ("===== FAILURES =====")
+PYTEST_SECTION_RE = re.compile(r"^=+ ", re.MULTILINE)
+
+# Windows executable resolution
 IS_WINDOWS = sys.platform == "win32"
 
 
-def run_command(cmd: Union[List[str], str], cwd: Path = None, timeout: int = 120,
-                capture_output: bool = True, text: bool = True) -> subprocess.CompletedProcess:
+# PATH lookups are resolved once per executable name
+_which = functools.lru_cache(maxsize=32)(shutil.which)
+
+
+def _platform_args(cmd: List[str]) -> List[str]:
+    """
+    Return the argv to run on this platform.
+
+    Commands always run without a shell. On Windows the executable is
+    resolved on PATH (honoring PATHEXT, so .cmd/.exe shims are found) since
+    CreateProcess does not search for them itself.
+    """
+    if IS_WINDOWS:
+        exe = _which(cmd[0])
+        if exe:
+            return [exe, *cmd[1:]]
+    return cmd
+
+
+def run_command(cmd: List[str], cwd: Path = None, timeout: int = 120,
+                capture_output: bool = True, text: bool = True,
+                env: Optional[dict] = None) -> subprocess.CompletedProcess:
     """Run a command with cross-platform support."""
-    if IS_WINDOWS and isinstance(cmd, list):
-        # Convert list to shell string for Windows
-        cmd_str = " ".join(f'"{c}"' if " " in str(c) else str(c) for c in cmd)
-        return subprocess.run(cmd_str, cwd=cwd, timeout=timeout,
-                              capture_output=capture_output, text=text, shell=True)
+    return subprocess.run(_platform_args(cmd), cwd=cwd, timeout=timeout,
+                          capture_output=capture_output, text=text, env=env)
+
+
+def _kill_tree(proc: subprocess.Popen):
+    """Kill a process started by run_command_streaming and everything it started."""
+    try:
+        if IS_WINDOWS:
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except (OSError, subprocess.SubprocessError):
+        pass
+    proc.kill()
+
+
+def run_command_streaming(cmd: List[str], cwd: Path = None, timeout: int = 120,
+                          tail_chars: int = STREAM_TAIL_CHARS,
+                          head_chars: int = 0,
+                          env: Optional[dict] = None) -> subprocess.CompletedProcess:
+    """
+    Run a command, reading its combined stdout/stderr as it is produced.
+
+    Only the first head_chars and last tail_chars characters (plus at most
+    one STREAM_CHUNK_CHARS read) are kept for the returned stdout, joined by
+    a "..." line if anything was dropped; a long line is read in pieces, so
+    memory stays bounded however much the command prints.
+
+    The command runs in its own process group. On timeout the whole group is
+    killed. Once the command exits, processes it left behind that still hold
+    the output open (a dev server, a leaked test worker) are killed after
+    STREAM_DRAIN_SECONDS rather than waited for.
+
+    Raises:
+        subprocess.TimeoutExpired: if the command runs longer than timeout
+    """
+    if IS_WINDOWS:
+        group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
     else:
-        return subprocess.run(cmd, cwd=cwd, timeout=timeout,
-                              capture_output=capture_output, text=text)
+        group = {"start_new_session": True}
+    proc = subprocess.Popen(_platform_args(cmd), cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True, bufsize=1,
+                            errors="replace", env=env, **group)
+
+    head = []
+    tail = deque()
+    state = {"head": 0, "tail": 0, "dropped": False}
+
+    def read():
+        for piece in iter(lambda: proc.stdout.readline(STREAM_CHUNK_CHARS), ""):
+            if state["head"] < head_chars:
+                head.append(piece)
+                state["head"] += len(piece)
+                continue
+            tail.append(piece)
+            state["tail"] += len(piece)
+            while state["tail"] > tail_chars and len(tail) > 1:
+                state["tail"] -= len(tail.popleft())
+                state["dropped"] = True
+
+    # Read on a thread so a pipe kept open by a grandchild cannot block the
+    # timeout; the main thread only waits for the command itself
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    timed_out = False
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        _kill_tree(proc)
+        returncode = proc.wait()
+    except BaseException:
+        # Ctrl+C only reaches our own process group; take the command down too
+        _kill_tree(proc)
+        raise
+    reader.join(STREAM_DRAIN_SECONDS)
+    if reader.is_alive():
+        # Processes the command left running still hold the pipe open
+        _kill_tree(proc)
+        reader.join(1.0)
+    if not reader.is_alive():
+        proc.stdout.close()
+
+    output = "".join(head) + ("...\n" if state["dropped"] else "") + "".join(tail)
+    if timed_out:
+        raise subprocess.TimeoutExpired(cmd, timeout, output=output)
+
+    return subprocess.CompletedProcess(cmd, returncode, stdout=output, stderr="")
+
+
+class _HeldOutput:
+    """
+    Stand-in for sys.stdout that holds back what selected threads print.
+
+    Everything other threads print goes straight to the wrapped stream.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._held = {}
+
+    def write(self, text: str) -> int:
+        held = self._held.get(threading.get_ident())
+        if held is None:
+            return self._stream.write(text)
+        held.append(text)
+        return len(text)
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+@contextlib.contextmanager
+def _held_output():
+    """Hold back what the current thread prints; yields the printed pieces."""
+    if not isinstance(sys.stdout, _HeldOutput):
+        sys.stdout = _HeldOutput(sys.stdout)
+    stdout = sys.stdout
+    held = []
+    stdout._held[threading.get_ident()] = held
+    try:
+        yield held
+    finally:
+        del stdout._held[threading.get_ident()]
+
+
+def parse_webhook_response(body: bytes) -> dict:
+    """
+    Parse the Teacher webhook's response body.
+
+    Accepts a JSON object, a list of objects (n8n "all items" responses), or
+    NDJSON frames streamed by n8n, whose fields are merged in order so that
+    partial results are kept. Raises ValueError if no JSON object is found.
+    """
+    try:
+        result = json_loads(body)
+    except ValueError:
+        result = None
+
+    if isinstance(result, dict):
+        return result
+    if isinstance(result, list) and result and isinstance(result[0], dict):
+        return result[0]
+
+    merged = {}
+    for line in body.splitlines():
+        try:
+            frame = json_loads(line)
+        except ValueError:
+            continue
+        if isinstance(frame, dict):
+            merged.update(frame)
+
+    if not merged:
+        raise ValueError("No JSON object in webhook response")
+    return merged
+
+
+def tail_sections(text: str, limit: int) -> str:
+    """
+    Keep as many trailing pytest report sections as fit in limit characters.
+
+    pytest opens each section (FAILURES, short test summary info, ...) with a
+    line of '=' characters. The useful detail is at the end of the output, so
+    whole sections are taken from the back rather than slicing off the front.
+    """
+    if len(text) <= limit:
+        return text
+
+    kept = len(text)
+    for match in reversed(list(PYTEST_SECTION_RE.finditer(text))):
+        if len(text) - match.start() > limit:
+            break
+        kept = match.start()
+
+    if kept == len(text):
+        # Even the last section is too long; keep its tail
+        return text[-limit:]
+    return text[kept:]
 
 
 class PromptLearningLoop:
@@ -72,26 +339,92 @@ class PromptLearningLoop:
         self.max_retries = max_retries
         self.auto_retry = auto_retry
         self.claude_md_path = Path.home() / ".claude" / "CLAUDE.md"
+        # Whether CLAUDE.md has the Learned Rules section, re-read only when the
+        # file's mtime differs from the one recorded at our last check or write
+        self._has_learned_section: Optional[bool] = None
+        self._claude_md_mtime: Optional[int] = None
+        # Rules waiting to be written to CLAUDE.md by _flush_rules()
+        self._pending_rules: List[str] = []
+        # Hashes of learned rules, used to skip duplicates (loaded on first use)
+        self.rule_hashes_path = self.claude_md_path.parent / ".rule_hashes"
+        self._rule_hashes: Optional[set] = None
+        self._pending_hashes: List[str] = []
 
         # Load config if provided
         self.config = self._load_config(config_path)
 
+        # Claude Code options, the same for every attempt
+        self._claude_options = [
+            "--output-format", self.config["claude"]["output_format"],
+            "--dangerously-skip-permissions",
+            "--max-turns", str(self.config["claude"]["max_turns"])
+        ]
+
+        # pygit2 repository (False if unavailable), opened on first use
+        self._repo = None
+        # Commit each attempt is diffed against and reset to, recorded by
+        # run(); HEAD moves if Claude Code commits during an attempt
+        self._base: Optional[str] = None
+
+        # Local Teacher LLM, created on first use
+        self._local_teacher: Optional["TeacherLLM"] = None
+        # Failures (task, errors, diff future) waiting for a full Teacher batch
+        self._pending_failures: List[Tuple[str, str, Future]] = []
+
+        # HTTP session for the n8n webhook, created on first use
+        self._session: Optional["requests.Session"] = None
+
+        # Environment for pytest subprocesses: reuse compiled bytecode across
+        # attempts. Claude Code and the orchestrator itself are left alone.
+        self._test_env = dict(os.environ)
+        if "PYTHONPYCACHEPREFIX" not in self._test_env:
+            try:
+                PYCACHE_PREFIX.mkdir(mode=0o700, parents=True, exist_ok=True)
+                self._test_env["PYTHONPYCACHEPREFIX"] = str(PYCACHE_PREFIX)
+            except OSError:
+                pass
+
+        # Installed pytest plugin distributions, probed on first use
+        self._pytest_plugins: Optional[set] = None
+        # Scratch directory for pytest JSON reports and shard caches, created on first use
+        self._report_dir: Optional[tempfile.TemporaryDirectory] = None
+        # Test node ids for sharded runs, collected once per attempt
+        self._collected_tests: Optional[List[str]] = None
+        # Runs the Teacher diff and analysis alongside the main loop (one task
+        # at a time, in submission order), created on first use
+        self._background: Optional[ThreadPoolExecutor] = None
+
     def _load_config(self, config_path: Optional[str]) -> dict:
-        """Load configuration from YAML file."""
+        """Load configuration from a YAML, TOML or JSON file."""
         default_config = {
             "teacher": {
                 "mode": "local",  # "local" or "webhook"
                 "model": "claude-3-5-haiku-20241022",
-                "max_tokens": 1024
+                "rule_model": "claude-3-5-haiku-20241022",  # Two-call fallback's rule step
+                "max_tokens": 600,  # Combined analysis + rule response
+                "max_diff_bytes": 32000,  # Diff read per failure; the Teacher picks hunks from it
+                "diff_context": 1,  # Unchanged lines around each change in the diff
+                "diff_exclude": ["*.lock", "package-lock.json", "*.min.js",
+                                 "node_modules/*", "vendor/*"],
+                "batch_failures": 1,  # Failures analyzed per Teacher call (local mode)
+                "cache_dir": "~/.claude/teacher_cache"  # Local mode responses; null disables
             },
             "n8n": {
                 "webhook_url": DEFAULT_N8N_WEBHOOK_URL,
-                "timeout": 60
+                "timeout": 60,
+                "compress_min_bytes": 4096,  # gzip larger request bodies; null disables
+                "max_response_bytes": 256 * 1024  # Cap on response bytes read
             },
             "tests": {
                 "framework": "pytest",
-                "command": "pytest tests/ -v --tb=short",
-                "timeout": 120
+                "command": "pytest tests/ --ff -v --tb=short",
+                "timeout": 120,
+                "parallel_workers": "auto",  # "auto" (cores - 2), int, or null
+                "shard": True,  # Shard across subprocesses if pytest-xdist is missing
+                "fail_fast": True  # Stop at the first failure (--maxfail=1)
+            },
+            "rules": {
+                "skip_paths": []  # Globs ignored when deciding if a diff is tests-only
             },
             "claude": {
                 "max_turns": 15,
@@ -99,30 +432,54 @@ class PromptLearningLoop:
             }
         }
 
-        if config_path and Path(config_path).exists():
-            with open(config_path) as f:
-                user_config = yaml.safe_load(f)
-                # Merge with defaults
-                for key in user_config:
-                    if key in default_config and isinstance(default_config[key], dict):
-                        default_config[key].update(user_config[key])
-                    else:
-                        default_config[key] = user_config[key]
+        if not (config_path and Path(config_path).exists()):
+            return default_config
+
+        path = Path(config_path)
+        stat = path.stat()
+        # Size guards against edits within the filesystem's mtime granularity
+        cache_key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+        if cache_key not in _CONFIG_CACHE:
+            user_config = self._parse_config_file(path) or {}
+            # Merge with defaults
+            for key in user_config:
+                if key in default_config and isinstance(default_config[key], dict):
+                    default_config[key].update(user_config[key])
+                else:
+                    default_config[key] = user_config[key]
+            _CONFIG_CACHE[cache_key] = default_config
+
+        # Callers mutate their config (e.g. the --teacher override), so copy
+        return copy.deepcopy(_CONFIG_CACHE[cache_key])
+
+    @staticmethod
+    def _parse_config_file(path: Path) -> dict:
+        """Parse a .json, .toml or YAML config file, using the fastest parser available."""
+        suffix = path.suffix.lower()
+
+        if suffix == ".json":
+            return json.loads(path.read_text())
+
+        if suffix == ".toml":
+            try:
+                import tomllib  # Python 3.11+
+            except ImportError:
+                import tomli as tomllib
+            return tomllib.loads(path.read_text())
 
-        return default_config
+        # YAML: prefer the libyaml-backed loader when PyYAML was built with it
+        import yaml
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        with open(path) as f:
+            return yaml.load(f, Loader=loader)
 
     def attempt_task(self, task: str) -> dict:
         """Run Claude Code in headless mode to attempt the task."""
-        cmd = [
-            "claude", "-p", task,
-            "--output-format", self.config["claude"]["output_format"],
-            "--dangerously-skip-permissions",
-            "--max-turns", str(self.config["claude"]["max_turns"])
-        ]
+        cmd = ["claude", "-p", task, *self._claude_options]
 
         print(f"  Command: {' '.join(cmd[:3])}...")
 
-        result = run_command(cmd, cwd=self.project_dir, timeout=600)
+        result = run_command_streaming(cmd, cwd=self.project_dir, timeout=600)
 
         return {
             "stdout": result.stdout,
@@ -130,23 +487,292 @@ class PromptLearningLoop:
             "code": result.returncode
         }
 
-    def run_tests(self) -> dict:
-        """Execute pytest test suite."""
-        test_cmd = self.config["tests"]["command"].split()
+    @staticmethod
+    def _runner_prefix(test_cmd: List[str]) -> List[str]:
+        """Return the part of the test command that invokes pytest itself."""
+        for i, arg in enumerate(test_cmd):
+            if "pytest" in Path(arg).name:
+                return test_cmd[:i + 1]
+        return test_cmd[:1]
+
+    def _pytest_plugin_available(self, test_cmd: List[str], plugin: str) -> bool:
+        """
+        Check whether the test runner has a pytest plugin distribution installed.
+
+        `pytest -VV` lists the registered third-party plugins; it is run once
+        and the result reused for every plugin lookup.
+        """
+        if self._pytest_plugins is None:
+            self._pytest_plugins = set()
+            try:
+                result = run_command(self._runner_prefix(test_cmd) + ["-VV"],
+                                     cwd=self.project_dir, timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                return False
+            # Lines look like "  pytest-xdist-3.8.0 at /path/to/xdist/plugin.py"
+            for line in (result.stdout + result.stderr).splitlines():
+                if line.startswith("  ") and " at " in line:
+                    self._pytest_plugins.add(line.split(" at ")[0].strip().rsplit("-", 1)[0])
+        return plugin in self._pytest_plugins
+
+    def _worker_count(self) -> int:
+        """Resolve tests.parallel_workers, leaving two cores for Claude Code and git."""
+        workers = self.config["tests"].get("parallel_workers")
+        if workers == "auto":
+            return max(1, (os.cpu_count() or 1) - 2)
+        return max(1, int(workers or 1))
+
+    def _collect_tests(self, test_cmd: List[str]) -> List[str]:
+        """Collect test node ids once per attempt (reset_attempt clears them)."""
+        if self._collected_tests is None:
+            result = run_command(test_cmd + ["--collect-only", "--verbosity=-1"],
+                                 cwd=self.project_dir,
+                                 timeout=self.config["tests"]["timeout"],
+                                 env=self._test_env)
+            self._collected_tests = [
+                line.strip() for line in result.stdout.splitlines() if "::" in line
+            ] if result.returncode == 0 else []
+        return self._collected_tests
+
+    def _run_sharded(self, test_cmd: List[str], shards: int) -> Optional[dict]:
+        """
+        Split the collected tests round-robin into shards and run them concurrently.
 
-        result = run_command(test_cmd, cwd=self.project_dir,
-                             timeout=self.config["tests"]["timeout"])
+        Returns None if there is nothing worth sharding, so the caller can fall
+        back to a single pytest run.
+        """
+        nodes = self._collect_tests(test_cmd)
+        shards = min(shards, len(nodes))
+        if shards < 2:
+            return None
+
+        # Keep runner and options, replace path arguments with each shard's node ids
+        prefix = self._runner_prefix(test_cmd)
+        args = test_cmd[len(prefix):]
+        options = [
+            arg for i, arg in enumerate(args)
+            if (i > 0 and args[i - 1] in PYTEST_VALUE_OPTIONS)
+            or not (self.project_dir / arg).exists()
+        ]
+        # Each shard gets its own pytest cache so they do not overwrite each
+        # other's lastfailed; the entries are merged once all have finished.
+        # The directory is created here, not by the shards racing in _run_pytest.
+        cache_dirs = [Path(self._report_directory()) / f"cache-{i}" for i in range(shards)]
+        for cache_dir in cache_dirs:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        commands = [
+            prefix + nodes[i::shards] + options + ["-o", f"cache_dir={cache_dirs[i]}"]
+            for i in range(shards)
+        ]
+
+        with ThreadPoolExecutor(max_workers=shards) as pool:
+            runs = list(pool.map(self._run_pytest, commands, range(shards)))
+        self._merge_lastfailed(cache_dirs)
+
+        results = [result for result, _ in runs]
+        failures = [f for _, f in runs if f]
+        return {
+            "stdout": "".join(r.stdout for r in results),
+            "stderr": "".join(r.stderr for r in results),
+            "code": max(r.returncode for r in results),
+            "failures": "\n\n".join(failures) or None
+        }
+
+    def _merge_lastfailed(self, cache_dirs: List[Path]):
+        """
+        Record the shards' failing tests in the project's pytest cache.
+
+        The next --lf run then sees the failures of all shards, as if the
+        suite had run in one process.
+        """
+        lastfailed = {}
+        for cache_dir in cache_dirs:
+            try:
+                lastfailed.update(json.loads(
+                    (cache_dir / "v" / "cache" / "lastfailed").read_text(encoding="utf-8")
+                ))
+            except (OSError, ValueError):
+                continue
+
+        cache = self.project_dir / ".pytest_cache"
+        target = cache / "v" / "cache" / "lastfailed"
+        try:
+            if not cache.exists():
+                target.parent.mkdir(parents=True)
+                # As pytest does, so `git add -A` never stages the cache
+                (cache / ".gitignore").write_text("# Created by pytest automatically.\n*\n")
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_text(json.dumps(lastfailed, indent=2, sort_keys=True), encoding="utf-8")
+        except OSError as e:
+            print(f"  [WARN] Could not record failing tests for --lf: {e}")
+
+    def _report_directory(self) -> str:
+        """Return the scratch directory for JSON reports and shard caches."""
+        if self._report_dir is None:
+            self._report_dir = tempfile.TemporaryDirectory(prefix="prompt-learning-")
+        return self._report_dir.name
+
+    def _run_pytest(self, test_cmd: List[str], index: int = 0
+                    ) -> Tuple[subprocess.CompletedProcess, Optional[str]]:
+        """
+        Run one pytest command.
+
+        With pytest-json-report installed, also returns just the failing
+        tests' tracebacks (None otherwise, or if the report is missing).
+        """
+        report = None
+        if self._pytest_plugin_available(test_cmd, "pytest-json-report"):
+            # Outside the project, so the report is never committed
+            report = Path(self._report_directory()) / f"report-{index}.json"
+            if report.exists():
+                report.unlink()
+            test_cmd = test_cmd + ["--json-report", f"--json-report-file={report}"]
+
+        result = run_command_streaming(test_cmd, cwd=self.project_dir,
+                                       timeout=self.config["tests"]["timeout"],
+                                       head_chars=TEST_HEAD_CHARS, env=self._test_env)
+        return result, self._read_failures(report) if report else None
+
+    @staticmethod
+    def _read_failures(report_path: Path) -> Optional[str]:
+        """Join the tracebacks of failed tests and collectors from a JSON report."""
+        try:
+            report = json.loads(report_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+        failures = [
+            f"{item['nodeid']}\n{item['longrepr']}"
+            for item in report.get("collectors", [])
+            if item.get("outcome") == "failed" and item.get("longrepr")
+        ]
+        for test in report.get("tests", []):
+            for stage in ("setup", "call", "teardown"):
+                info = test.get(stage) or {}
+                if info.get("outcome") == "failed" and info.get("longrepr"):
+                    failures.append(f"{test['nodeid']}\n{info['longrepr']}")
+
+        return "\n\n".join(failures) or None
+
+    def run_tests(self, scope: str = "full") -> dict:
+        """
+        Execute pytest test suite, in parallel when possible.
+
+        With scope="lf", only the tests that failed on the previous run are
+        executed (serially, stopping at the first failure). Exit code 5 means
+        pytest had no recorded failures to rerun.
+        """
+        # Honor quoted arguments in the configured command. POSIX rules strip
+        # the quotes on every platform (no shell sees the command); on Windows
+        # backslashes are path separators, so they are kept literally
+        command = self.config["tests"]["command"]
+        if IS_WINDOWS:
+            command = command.replace("\\", "\\\\")
+        test_cmd = shlex.split(command)
+        workers = self._worker_count()
+
+        # One failure is enough for the Teacher; xdist also honors --maxfail
+        if self.config["tests"].get("fail_fast", True) and not any(
+            arg == "-x" or arg.startswith("--maxfail") for arg in test_cmd
+        ):
+            test_cmd.append("--maxfail=1")
+
+        if scope == "lf":
+            test_cmd += ["--lf", "--lfnf=none"]
+            if "-x" not in test_cmd:
+                test_cmd.append("-x")
+        elif workers > 1 and "-n" not in test_cmd:
+            if self._pytest_plugin_available(test_cmd, "pytest-xdist"):
+                # loadfile keeps each file's fixtures on a single worker
+                test_cmd += ["-n", str(workers), "--dist=loadfile"]
+            elif self.config["tests"].get("shard", True):
+                sharded = self._run_sharded(test_cmd, workers)
+                if sharded is not None:
+                    return sharded
+
+        result, failures = self._run_pytest(test_cmd)
 
         return {
             "stdout": result.stdout,
             "stderr": result.stderr,
-            "code": result.returncode
+            "code": result.returncode,
+            "failures": failures
         }
 
+    def _changed_files(self) -> List[str]:
+        """List the paths changed by the staged attempt."""
+        result = run_command(["git", "diff", "--cached", "--name-only", self._base_ref()],
+                             cwd=self.project_dir)
+        return [line for line in result.stdout.splitlines() if line.strip()]
+
     def get_diff(self) -> str:
-        """Get git diff of changes (commit-based)."""
-        result = run_command(["git", "diff", "HEAD~1"], cwd=self.project_dir)
-        return result.stdout
+        """
+        Get git diff of the staged attempt against the run's base commit.
+
+        Files matching teacher.diff_exclude (lock files, vendored code) are left
+        out, and reading stops at teacher.max_diff_bytes; the Teacher picks the
+        hunks it sends from that much and drops one cut off at the end. A
+        minimal diff with teacher.diff_context lines of context keeps the
+        payload small.
+        """
+        exclude = self.config["teacher"].get("diff_exclude") or []
+        paths = [
+            path for path in self._changed_files()
+            if not any(fnmatch(path, pattern) for pattern in exclude)
+        ]
+        if not paths:
+            return ""
+
+        limit = self.config["teacher"].get("max_diff_bytes", 32000)
+        context = self.config["teacher"].get("diff_context", 1)
+        proc = subprocess.Popen(
+            _platform_args(["git", "-c", "color.ui=never", "diff", "--no-color", "--minimal",
+                            f"--unified={context}", "--cached", self._base_ref(), "--", *paths]),
+            cwd=self.project_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            env={**os.environ, "GIT_PAGER": "cat"}
+        )
+        try:
+            data = proc.stdout.read(limit)
+        finally:
+            # Stop git early instead of draining output we would discard
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+
+        return data.decode("utf-8", errors="replace")
+
+    def prefetch_diff(self) -> Future:
+        """
+        Start get_diff() in the background and return its future.
+
+        The attempt is already staged and the diff reads only the index, so it
+        is fixed and git can produce it while pytest is still running.
+        """
+        return self._submit_background(self.get_diff)
+
+    def _submit_background(self, fn: Callable, *args) -> Future:
+        """Queue fn on the background worker."""
+        if self._background is None:
+            self._background = ThreadPoolExecutor(max_workers=1)
+        return self._background.submit(fn, *args)
+
+    def _submit_learning(self, fn: Callable, *args) -> Future:
+        """
+        Queue a Teacher step (Steps 4-5) on the background worker.
+
+        What it prints is held back and becomes the future's result, so the
+        caller can print it in step order rather than in the middle of
+        whatever the main thread is printing meanwhile.
+        """
+        def learn() -> str:
+            with _held_output() as held:
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print(f"  [FAIL] Learning from failure failed: {e}")
+            return "".join(held)
+
+        return self._submit_background(learn)
 
     def analyze_failure(self, diff: str, errors: str, task: str) -> dict:
         """
@@ -161,6 +787,33 @@ class PromptLearningLoop:
         else:
             return self.analyze_failure_via_webhook(diff, errors, task)
 
+    def analyze_failures(self, cases: List[dict]) -> List[dict]:
+        """
+        Analyze several failures (dicts with diff, errors, task).
+
+        In local mode they share a single Teacher call; otherwise, or if the
+        local Teacher is unavailable, each is analyzed on its own.
+        """
+        if self.config["teacher"]["mode"] == "local" and len(cases) > 1:
+            try:
+                return self._teacher().analyze_failures_batch(cases)
+            except (ImportError, ValueError) as e:
+                print(f"  [WARN] {e}")
+        return [self.analyze_failure(**case) for case in cases]
+
+    def _teacher(self) -> "TeacherLLM":
+        """Create the local Teacher on first use and reuse it across attempts."""
+        if self._local_teacher is None:
+            from teacher import TeacherLLM
+
+            self._local_teacher = TeacherLLM(
+                model=self.config["teacher"]["model"],
+                max_tokens=self.config["teacher"]["max_tokens"],
+                cache_dir=self.config["teacher"].get("cache_dir"),
+                rule_model=self.config["teacher"].get("rule_model")
+            )
+        return self._local_teacher
+
     def analyze_failure_local(self, diff: str, errors: str, task: str) -> dict:
         """
         Analyze failure using local Anthropic SDK.
@@ -168,13 +821,7 @@ class PromptLearningLoop:
         Requires ANTHROPIC_API_KEY environment variable.
         """
         try:
-            from teacher import TeacherLLM
-
-            model = self.config["teacher"]["model"]
-            max_tokens = self.config["teacher"]["max_tokens"]
-
-            teacher = TeacherLLM(model=model, max_tokens=max_tokens)
-            return teacher.analyze_failure(diff, errors, task)
+            return self._teacher().analyze_failure(diff, errors, task)
 
         except ImportError as e:
             print(f"  [WARN] Teacher module not available: {e}")
@@ -189,6 +836,42 @@ class PromptLearningLoop:
             print(f"  [WARN] Local analysis failed: {e}")
             return {"analysis": "", "rule": "", "error_type": "local_analysis_error"}
 
+    def _http_session(self) -> "requests.Session":
+        """
+        Get the pooled HTTP session used for webhook calls.
+
+        Connections are kept alive across retries, and transient n8n Cloud
+        errors (429/5xx, failed connects) are retried with backoff. A read
+        timeout is not retried.
+        """
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=3,
+                # A read timeout means n8n is already running the workflow;
+                # re-raise it (as requests' Timeout) instead of running it again
+                read=False,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=None  # Include POST; the Teacher call has no side effects
+            )
+            # Every call goes to the single webhook host
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+
+            self._session = requests.Session()
+            self._session.headers.update({
+                "Content-Type": "application/json",
+                "Connection": "keep-alive",
+                "Accept-Encoding": "gzip"
+            })
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+
+        return self._session
+
     def analyze_failure_via_webhook(self, diff: str, errors: str, task: str) -> dict:
         """
         Call n8n webhook for Teacher LLM analysis.
@@ -196,26 +879,41 @@ class PromptLearningLoop:
         Sends the diff, error logs, and task description to the n8n workflow
         which uses Claude to analyze the failure and generate a preventive rule.
         """
+        import requests
+
         webhook_url = self.config["n8n"]["webhook_url"]
         timeout = self.config["n8n"]["timeout"]
 
-        # Truncate large inputs to avoid payload issues
+        # Truncate large inputs to avoid payload issues. For errors keep the
+        # last pytest sections, which hold the failure details.
         payload = {
             "diff": diff[:10000] if diff else "",
-            "error_logs": errors[:5000] if errors else "",
+            "error_logs": tail_sections(ANSI_ESCAPE_RE.sub("", errors), 5000) if errors else "",
             "task_description": task
         }
 
+        headers = {}
+        body = json.dumps(payload).encode("utf-8")
+        min_compress = self.config["n8n"].get("compress_min_bytes")
+        if min_compress is not None and len(body) >= min_compress:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+
         try:
-            response = requests.post(
+            response = self._http_session().post(
                 webhook_url,
-                json=payload,
+                data=body,
                 timeout=timeout,
-                headers={"Content-Type": "application/json"}
+                headers=headers,
+                stream=True
             )
-            response.raise_for_status()
+            with response:
+                response.raise_for_status()
+                # Read at most max_response_bytes; n8n error traces can be huge
+                max_bytes = self.config["n8n"].get("max_response_bytes", 256 * 1024)
+                raw = response.raw.read(max_bytes, decode_content=True)
 
-            result = response.json()
+            result = parse_webhook_response(raw)
 
             # Handle the response format from n8n
             return {
@@ -230,67 +928,251 @@ class PromptLearningLoop:
         except requests.exceptions.RequestException as e:
             print(f"  [WARN] Webhook request failed: {e}")
             return {"analysis": "", "rule": "", "error_type": "request_failed"}
-        except json.JSONDecodeError:
+        except ValueError:
             print(f"  [WARN] Invalid JSON response from webhook")
             return {"analysis": "", "rule": "", "error_type": "invalid_response"}
 
-    def append_rule(self, rule: str, error_type: str = "Unknown"):
-        """Append learned rule to CLAUDE.md with metadata."""
+    def append_rule(self, rule: str, error_type: str = "Unknown") -> bool:
+        """
+        Queue a learned rule with metadata for CLAUDE.md.
+
+        Rules are written in one batch by _flush_rules().
+
+        Returns:
+            True if the rule was queued, False if it was empty or already learned
+        """
         if not rule.strip():
             print("  [WARN] No rule to append (empty)")
-            return
+            return False
+
+        # Skip rules already learned (normalized for case and whitespace)
+        digest = self._rule_digest(rule)
+        if digest in self._load_rule_hashes():
+            print("  [SKIP] duplicate rule")
+            return False
+        self._rule_hashes.add(digest)
+        self._pending_hashes.append(digest)
 
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
 
         # Format the entry
-        entry = f"""
+        self._pending_rules.append(f"""
 {rule}
   - **Source**: Learned on {timestamp} from {error_type}
-"""
+""")
+        return True
+
+    def _flush_rules(self):
+        """Append all queued rules to CLAUDE.md with a single write."""
+        if not self._pending_rules:
+            return
 
-        # Read existing content to check for Learned Rules section
-        content = ""
-        if self.claude_md_path.exists():
-            content = self.claude_md_path.read_text()
+        # Check whether the Learned Rules section exists, unless CLAUDE.md is
+        # unchanged since we last looked
+        try:
+            mtime = self.claude_md_path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._has_learned_section is None or mtime != self._claude_md_mtime:
+            self._has_learned_section = (
+                mtime is not None
+                and LEARNED_SECTION_HEADER in self.claude_md_path.read_text()
+            )
 
-        # Check if Learned Rules section exists
-        if "## Learned Rules & Patterns" not in content:
+        content = "".join(self._pending_rules)
+        if not self._has_learned_section:
             # Add the section header first
-            entry = f"""
-## Learned Rules & Patterns
+            content = f"""
+{LEARNED_SECTION_HEADER}
 
 Rules automatically generated from the Prompt Learning Loop.
 
-{entry}"""
+{content}"""
 
-        with open(self.claude_md_path, "a") as f:
-            f.write(entry)
+        # One O_APPEND write: the header and rules land together at the end
+        # of the file, even if another loop is appending concurrently
+        fd = os.open(self.claude_md_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, content.encode("utf-8"))
+            os.fsync(fd)
+            self._claude_md_mtime = os.fstat(fd).st_mtime_ns
+        finally:
+            os.close(fd)
+        self._has_learned_section = True
+
+        print(f"  [OK] {len(self._pending_rules)} rule(s) appended to {self.claude_md_path}")
+        self._pending_rules.clear()
+        self._save_rule_hashes()
+
+    @staticmethod
+    def _rule_digest(rule: str) -> str:
+        """Hash a rule, ignoring case and whitespace differences."""
+        return hashlib.sha1(re.sub(r"\s+", " ", rule.lower().strip()).encode()).hexdigest()
+
+    def _load_rule_hashes(self) -> set:
+        """
+        Load (once) the hashes of rules already appended to CLAUDE.md.
+
+        Without a hash file (first run, or rules learned before it existed),
+        the hashes are rebuilt from the Learned Rules section and saved with
+        the next flush.
+        """
+        if self._rule_hashes is None:
+            try:
+                self._rule_hashes = set(self.rule_hashes_path.read_text().split())
+            except OSError:
+                self._rule_hashes = self._hashes_from_claude_md()
+                self._pending_hashes.extend(self._rule_hashes)
+        return self._rule_hashes
+
+    def _hashes_from_claude_md(self) -> set:
+        """Hash the "### ..." rules in CLAUDE.md's Learned Rules section."""
+        try:
+            text = self.claude_md_path.read_text()
+        except OSError:
+            return set()
 
-        print(f"  [OK] Rule appended to {self.claude_md_path}")
+        _, found, section = text.partition(LEARNED_SECTION_HEADER)
+        if not found:
+            return set()
+        # Stop at the next top-level section, if any
+        section = re.split(r"(?m)^## ", section, maxsplit=1)[0]
 
-    def commit_attempt(self, attempt_num: int) -> bool:
-        """Commit changes for diff tracking."""
-        # Stage all changes
-        run_command(["git", "add", "."], cwd=self.project_dir)
+        return {
+            self._rule_digest(RULE_SOURCE_RE.sub("", block))
+            for block in re.split(r"(?m)^(?=### )", section)
+            if block.startswith("### ")
+        }
+
+    def _save_rule_hashes(self):
+        """Record newly appended rule hashes, keeping only the most recent ones."""
+        if not self._pending_hashes:
+            return
 
-        # Check if there are changes to commit
-        status = run_command(["git", "status", "--porcelain"], cwd=self.project_dir)
+        with open(self.rule_hashes_path, "a") as f:
+            f.write("".join(f"{digest}\n" for digest in self._pending_hashes))
+        self._pending_hashes.clear()
 
-        if not status.stdout.strip():
-            print("  [WARN] No changes to commit")
-            return False
+        if len(self._rule_hashes) > RULE_HASH_LIMIT:
+            recent = self.rule_hashes_path.read_text().split()[-RULE_HASH_LIMIT:]
+            self.rule_hashes_path.write_text("".join(f"{digest}\n" for digest in recent))
+            self._rule_hashes = set(recent)
 
-        # Commit
-        result = run_command(
-            ["git", "commit", "-m", f"Learning Loop Attempt {attempt_num}"],
-            cwd=self.project_dir
-        )
+    def _git_repo(self):
+        """
+        Open the project with pygit2 (once) for in-process git operations.
+
+        Returns None if pygit2 is not installed or cannot open the project,
+        in which case the git CLI is used.
+        """
+        if self._repo is None:
+            try:
+                import pygit2
+                self._repo = pygit2.Repository(str(self.project_dir))
+            except Exception:
+                self._repo = False
+        return self._repo or None
+
+    def _base_ref(self) -> str:
+        """Return the run's base commit, or HEAD outside of run()."""
+        return self._base or "HEAD"
+
+    def _record_base(self):
+        """Remember the commit the run starts from (see _base)."""
+        result = run_command(["git", "rev-parse", "--verify", "-q", "HEAD"],
+                             cwd=self.project_dir)
+        self._base = result.stdout.strip() if result.returncode == 0 else None
+
+    def stage_attempt(self) -> bool:
+        """
+        Stage all of the attempt's changes (including any commits Claude Code
+        made) so they can be diffed against the run's base commit.
+
+        Nothing is committed until the tests pass, so a failed attempt only
+        needs its staged changes discarded (see reset_attempt).
+
+        Returns:
+            True if the attempt changed anything
+        """
+        repo = self._git_repo()
+        if repo is not None:
+            try:
+                return self._stage_in_process(repo, self._base_ref())
+            except Exception as e:
+                print(f"  [WARN] pygit2 staging failed ({e}), using git CLI")
+
+        run_command(["git", "add", "-A"], cwd=self.project_dir)
 
+        # Exit code 1 means the index differs from the base commit
+        result = run_command(["git", "diff", "--cached", "--quiet", self._base_ref()],
+                             cwd=self.project_dir)
+        return result.returncode == 1
+
+    @staticmethod
+    def _stage_in_process(repo, base: str) -> bool:
+        """Stage everything with pygit2, without forking git."""
+        import pygit2
+
+        # Re-read first in case the git CLI touched the index
+        repo.index.read()
+        repo.index.add_all()
+        repo.index.write()
+
+        tree = repo.revparse_single(base).peel(pygit2.Tree)
+        return len(repo.index.diff_to_tree(tree)) > 0
+
+    def commit_attempt(self, attempt_num: int) -> bool:
+        """
+        Commit the staged changes of a successful attempt.
+
+        If Claude Code already committed all of them, there is nothing left
+        to commit and its commits are kept as they are.
+        """
+        message = f"Learning Loop Attempt {attempt_num}"
+
+        repo = self._git_repo()
+        if repo is not None:
+            try:
+                signature = repo.default_signature
+                parents = [] if repo.head_is_unborn else [repo.head.target]
+                repo.index.read()
+                tree = repo.index.write_tree()
+                if parents and repo.head.peel().tree_id == tree:
+                    return True
+                repo.create_commit("HEAD", signature, signature, message, tree, parents)
+                return True
+            except Exception as e:
+                print(f"  [WARN] pygit2 commit failed ({e}), using git CLI")
+
+        if run_command(["git", "diff", "--cached", "--quiet", "HEAD"],
+                       cwd=self.project_dir).returncode == 0:
+            return True
+        result = run_command(["git", "commit", "-m", message], cwd=self.project_dir)
         return result.returncode == 0
 
     def reset_attempt(self):
-        """Reset to before the failed attempt."""
-        run_command(["git", "reset", "--hard", "HEAD~1"], cwd=self.project_dir)
+        """
+        Discard the failed attempt's staged and working tree changes.
+
+        The reset goes to the run's base commit, so commits Claude Code made
+        during the attempt are discarded too. Untracked, ignored files such as
+        .pytest_cache/ survive the hard reset, so the next attempt can use
+        --ff/--lf against this attempt's failures.
+        The collected test ids are dropped, since the reset may remove tests
+        the attempt added.
+        """
+        self._collected_tests = None
+        repo = self._git_repo()
+        if repo is not None:
+            try:
+                import pygit2
+                repo.index.read()
+                repo.reset(repo.revparse_single(self._base_ref()).id, pygit2.GIT_RESET_HARD)
+                return
+            except Exception as e:
+                print(f"  [WARN] pygit2 reset failed ({e}), using git CLI")
+
+        run_command(["git", "reset", "--hard", self._base_ref()], cwd=self.project_dir)
 
     def report_manual_failure(
         self,
@@ -312,7 +1194,8 @@ Rules automatically generated from the Prompt Learning Loop.
             task: The original task that was being attempted
 
         Returns:
-            True if rule was successfully generated and appended
+            True if rule was successfully generated and appended; False if none
+            was generated or it was already learned
         """
         print(f"\n{'='*60}")
         print("MANUAL FAILURE REPORT")
@@ -338,7 +1221,12 @@ Rules automatically generated from the Prompt Learning Loop.
         if rule:
             print(f"  New Rule: {rule[:100]}...")
             # Use provided failure_type, not extracted one
-            self.append_rule(rule, f"{failure_type} (manual report)")
+            if not self.append_rule(rule, f"{failure_type} (manual report)"):
+                print(f"\n{'='*60}")
+                print("[SKIP] Rule already in CLAUDE.md, nothing appended")
+                print(f"{'='*60}")
+                return False
+            self._flush_rules()
             print(f"\n{'='*60}")
             print("[OK] SUCCESS: Rule appended to CLAUDE.md")
             print(f"{'='*60}")
@@ -350,6 +1238,97 @@ Rules automatically generated from the Prompt Learning Loop.
             print(f"{'='*60}")
             return False
 
+    def _diff_is_tests_only(self) -> bool:
+        """
+        Check whether the attempt only touched tests (or rules.skip_paths).
+
+        There is no coding mistake for the Teacher to learn from in that case.
+        """
+        skip_paths = self.config["rules"].get("skip_paths") or []
+        paths = self._changed_files()
+        return bool(paths) and all(
+            TEST_PATH_RE.search(path) or any(fnmatch(path, p) for p in skip_paths)
+            for path in paths
+        )
+
+    def _diff_fingerprint(self, task: str, staged: bool = True) -> str:
+        """
+        Hash the attempt's changed blobs together with the task.
+
+        Claude often oscillates between equivalent patches across retries; an
+        identical fingerprint means the Teacher has already seen this change.
+        With staged=False (the attempt changed nothing) git is not consulted.
+        """
+        raw = ""
+        if staged:
+            raw = run_command(["git", "diff", "--cached", "--raw", "--no-color", self._base_ref()],
+                              cwd=self.project_dir).stdout
+        return hashlib.sha256(f"{task}\0{raw}".encode()).hexdigest()
+
+    def _learn_from_failure(self, task: str, errors: str,
+                            diff_future: Optional[Future] = None):
+        """Run the Teacher on a failed attempt and append the resulting rule."""
+        # Step 4: Analyze failure with Teacher LLM
+        teacher_mode = self.config["teacher"]["mode"]
+        print(f"\n> Step 4: Analyzing failure with Teacher LLM ({teacher_mode} mode)...")
+        try:
+            diff = diff_future.result() if diff_future else self.get_diff()
+            analysis = self.analyze_failure(
+                diff=diff,
+                errors=errors,
+                task=task
+            )
+            print(f"  [OK] Analysis received")
+
+            if analysis.get("analysis"):
+                print(f"  Root Cause: {analysis['analysis'][:100]}...")
+        except Exception as e:
+            print(f"  [FAIL] Analysis failed: {e}")
+            analysis = {"rule": "", "error_type": "analysis_failed"}
+
+        # Step 5: Append rule to CLAUDE.md
+        print("\n> Step 5: Learning from failure...")
+        self._learn_rule(analysis)
+
+    def _learn_from_failures(self, failures: List[Tuple[str, str, Future]]):
+        """Run the Teacher once on a batch of failed attempts and append their rules."""
+        # Step 4: Analyze the failures with one Teacher call
+        teacher_mode = self.config["teacher"]["mode"]
+        print(f"\n> Step 4: Analyzing {len(failures)} failure(s) with Teacher LLM "
+              f"({teacher_mode} mode)...")
+        try:
+            cases = [
+                {"diff": diff_future.result(), "errors": errors, "task": task}
+                for task, errors, diff_future in failures
+            ]
+            analyses = self.analyze_failures(cases)
+            print(f"  [OK] {len(analyses)} analysis result(s) received")
+        except Exception as e:
+            print(f"  [FAIL] Analysis failed: {e}")
+            analyses = []
+
+        # Step 5: Append rules to CLAUDE.md
+        print("\n> Step 5: Learning from failures...")
+        for analysis in analyses or [{}]:
+            self._learn_rule(analysis)
+
+    def _submit_failure_batch(self) -> Optional[Future]:
+        """Start the background analysis of the queued failures, if any."""
+        if not self._pending_failures:
+            return None
+        failures = self._pending_failures[:]
+        self._pending_failures.clear()
+        return self._submit_learning(self._learn_from_failures, failures)
+
+    def _learn_rule(self, analysis: dict):
+        """Queue the rule from a Teacher analysis for CLAUDE.md."""
+        rule = analysis.get("rule", "")
+        if rule:
+            print(f"  New Rule: {rule[:100]}...")
+            self.append_rule(rule, analysis.get("error_type", "test failure"))
+        else:
+            print("  [WARN] No rule generated")
+
     def run(self, task: str) -> bool:
         """Main learning loop."""
         print(f"\n{'='*60}")
@@ -361,11 +1340,40 @@ Rules automatically generated from the Prompt Learning Loop.
         print(f"Auto-Retry: {self.auto_retry}")
         print(f"{'='*60}")
 
+        self._record_base()
+        try:
+            result = self._run_attempts(task)
+            # Failures still waiting for a full batch are analyzed now
+            learning = self._submit_failure_batch()
+            if learning is not None:
+                print(learning.result(), end="")
+            return result
+        finally:
+            # Let a Teacher analysis still in flight queue its rule, then write
+            # any rules still queued, even if the loop was interrupted
+            if self._background is not None:
+                self._background.shutdown(wait=True)
+                self._background = None
+            self._flush_rules()
+            if self._local_teacher is not None:
+                self._local_teacher.close()
+                self._local_teacher = None
+
+    def _run_attempts(self, task: str) -> bool:
+        """Attempt the task up to max_retries times, learning from each failure."""
+        # After a failing attempt, first rerun only the failing tests (--lf)
+        rerun_failed_first = False
+        # Fingerprints of diffs the Teacher has already seen in this run
+        seen_diffs = set()
         for attempt in range(1, self.max_retries + 1):
             print(f"\n{'-'*50}")
             print(f"ATTEMPT {attempt}/{self.max_retries}")
             print(f"{'-'*50}")
 
+            # Rules learned from the previous attempt must be in CLAUDE.md
+            # before Claude Code runs again
+            self._flush_rules()
+
             # Step 1: Attempt the task
             print("\n> Step 1: Executing task with Claude Code...")
             try:
@@ -378,27 +1386,46 @@ Rules automatically generated from the Prompt Learning Loop.
                 print(f"  [FAIL] Task execution failed: {e}")
                 continue
 
-            # Step 2: Commit changes for diff
-            print("\n> Step 2: Committing changes...")
-            if not self.commit_attempt(attempt):
+            # Step 2: Stage changes for diff
+            print("\n> Step 2: Staging changes...")
+            changed = self.stage_attempt()
+            if not changed:
                 print("  [WARN] No changes were made by Claude")
                 # Continue anyway to run tests
 
+            # Collect the diff for the Teacher while the tests run; with
+            # nothing staged there is no diff to collect
+            if changed:
+                diff_future = self.prefetch_diff()
+            else:
+                diff_future = Future()
+                diff_future.set_result("")
+
             # Step 3: Run pytest
             print("\n> Step 3: Running tests...")
             try:
-                test_result = self.run_tests()
+                test_result = None
+                if rerun_failed_first:
+                    test_result = self.run_tests(scope="lf")
+                    if test_result["code"] in (0, 5):
+                        print("  [OK] Previously failing tests pass, running full suite...")
+                        test_result = None
+                if test_result is None:
+                    test_result = self.run_tests()
             except subprocess.TimeoutExpired:
                 print("  [FAIL] Tests timed out")
                 continue
 
             if test_result["code"] == 0:
+                if changed and not self.commit_attempt(attempt):
+                    print("  [WARN] Could not commit the successful attempt")
                 print("\n" + "="*50)
                 print("[OK] SUCCESS: All tests passed!")
                 print("="*50)
                 return True
 
             print(f"  [FAIL] Tests failed (exit code: {test_result['code']})")
+            rerun_failed_first = True
 
             # Show test output summary
             output = test_result["stderr"] or test_result["stdout"]
@@ -408,37 +1435,44 @@ Rules automatically generated from the Prompt Learning Loop.
                 for line in lines[-5:]:
                     print(f"    {line[:80]}")
 
-            # Step 4: Analyze failure with Teacher LLM
-            teacher_mode = self.config["teacher"]["mode"]
-            print(f"\n> Step 4: Analyzing failure with Teacher LLM ({teacher_mode} mode)...")
-            try:
-                diff = self.get_diff()
-                analysis = self.analyze_failure(
-                    diff=diff,
-                    errors=output,
-                    task=task
-                )
-                print(f"  [OK] Analysis received")
-
-                if analysis.get("analysis"):
-                    print(f"  Root Cause: {analysis['analysis'][:100]}...")
-            except Exception as e:
-                print(f"  [FAIL] Analysis failed: {e}")
-                analysis = {"rule": "", "error_type": "analysis_failed"}
-
-            # Step 5: Append rule to CLAUDE.md
-            print("\n> Step 5: Learning from failure...")
-            rule = analysis.get("rule", "")
-            if rule:
-                print(f"  New Rule: {rule[:100]}...")
-                self.append_rule(rule, analysis.get("error_type", "test failure"))
+            # Steps 4-5: Analyze failure and learn a rule, in the background
+            learning: Optional[Future] = None
+            fingerprint = self._diff_fingerprint(task, staged=changed)
+            if changed and self._diff_is_tests_only():
+                print("\n> Step 4: [SKIP] diff is tests-only, no rule to learn")
+            elif fingerprint in seen_diffs:
+                print("\n> Step 4: [SKIP] identical diff already analyzed")
             else:
-                print("  [WARN] No rule generated")
-
-            # Step 6: Reset for retry
-            print("\n> Step 6: Resetting for next attempt...")
-            self.reset_attempt()
-            print("  [OK] Reset complete")
+                seen_diffs.add(fingerprint)
+                # Prefer the failing tests' tracebacks over the full log
+                failure = (task, test_result.get("failures") or output, diff_future)
+                batch_size = self.config["teacher"].get("batch_failures") or 1
+                if batch_size > 1:
+                    # Rules from queued failures only reach CLAUDE.md once the
+                    # batch is full (or the loop ends)
+                    self._pending_failures.append(failure)
+                    if len(self._pending_failures) >= batch_size:
+                        learning = self._submit_failure_batch()
+                    else:
+                        print(f"\n> Step 4: Failure queued for batched analysis "
+                              f"({len(self._pending_failures)}/{batch_size})")
+                else:
+                    # Analyze while this attempt is reset; the next attempt
+                    # waits for the rule
+                    learning = self._submit_learning(self._learn_from_failure, *failure)
+
+            # Step 6: Reset for retry while the Teacher works. Its output is
+            # printed once it is done, ahead of this step's, so the log stays
+            # in step order.
+            with _held_output() as reset_log:
+                print("\n> Step 6: Resetting for next attempt...")
+                # Don't reset while git may still be reading the staged attempt
+                wait([diff_future])
+                self.reset_attempt()
+                print("  [OK] Reset complete")
+            if learning is not None:
+                print(learning.result(), end="")
+            print("".join(reset_log), end="")
 
             if not self.auto_retry:
                 print("\n[WARN] Auto-retry disabled. Stopping for manual review.")
@@ -511,7 +1545,7 @@ Examples:
     )
     run_parser.add_argument(
         "--config", "-c",
-        help="Path to config.yaml file"
+        help="Path to config file (.yaml, .toml or .json)"
     )
 
     # ========== 'report-failure' subcommand ==========
@@ -568,7 +1602,7 @@ Example:
     )
     report_parser.add_argument(
         "--config", "-c",
-        help="Path to config.yaml file"
+        help="Path to config file (.yaml, .toml or .json)"
     )
 
     args = parser.parse_args()
@@ -6,14 +6,358 @@ Provides AI-powered analysis of test failures and generates preventive rules
 for CLAUDE.md using the Anthropic SDK directly.
 """
 
+import hashlib
+import json
 import os
 import re
-from typing import Optional
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
 
 try:
-    import anthropic
+    import ahocorasick  # Optional: single-pass scan for literal error names
 except ImportError:
-    anthropic = None
+    ahocorasick = None
+
+# The Anthropic SDK takes about a second to import, so get_client() loads it
+# on first use rather than every import of this module
+anthropic = None
+
+# Responses shared by all TeacherLLM instances in this process, keyed by a
+# hash of the full request. Retries often resend an identical request.
+_RESPONSE_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_RESPONSE_CACHE_SIZE = 128
+# Guards _RESPONSE_CACHE and _CACHE_STATS; failures may be analyzed concurrently
+_cache_lock = threading.Lock()
+_CACHE_STATS = {"hits": 0, "disk_hits": 0, "similar_hits": 0, "misses": 0}
+
+# Run-specific noise dropped before comparing failures (see _failure_signature):
+# blob ids and hunk positions in diffs; line numbers, addresses, durations,
+# pytest temp paths and install locations in error logs. Changed code lines
+# are kept as they are.
+_DIFF_NOISE = [
+    (re.compile(r"^index [0-9a-f]+\.\.[0-9a-f]+.*$", re.MULTILINE), "index"),
+    (re.compile(r"^@@ [^@]* @@", re.MULTILINE), "@@"),
+]
+_ERROR_NOISE = [
+    (re.compile(r"\bline \d+"), "line N"),
+    (re.compile(r":\d+(?=[:\s)])"), ":N"),
+    (re.compile(r"\b0x[0-9a-fA-F]+\b"), "0xN"),
+    (re.compile(r"\b\d+(?:\.\d+)?s\b"), "Ns"),
+    (re.compile(r"/pytest-of-[^/\s]+/pytest-\d+/"), "/pytest/"),
+    (re.compile(r"[^\s\"']*[/\\](?:site|dist)-packages(?=[/\\])"), "<sp>"),
+]
+
+
+# Retries for rate limits (429), overloaded/5xx responses and dropped
+# connections; the SDK backs off exponentially with jitter and honors
+# Retry-After, so one flaky response does not lose a failure's analysis
+API_MAX_RETRIES = 5
+
+# Anthropic client shared by all TeacherLLM instances, so its connection pool
+# (and TLS sessions) survive across failures; created by get_client()
+# and released by close_client()
+_client_lock = threading.Lock()
+_shared_client = None
+_shared_client_key: Optional[str] = None
+
+
+def get_client() -> "anthropic.Anthropic":
+    """
+    Return the process-wide Anthropic client, creating it on first use.
+
+    A new client is only created if ANTHROPIC_API_KEY has changed. Transient
+    API errors are retried by the client (see API_MAX_RETRIES).
+
+    Raises:
+        ImportError: if the anthropic package is not installed
+        ValueError: if ANTHROPIC_API_KEY is not set
+    """
+    global anthropic, _shared_client, _shared_client_key
+
+    if anthropic is None:
+        try:
+            import anthropic as sdk
+        except ImportError:
+            raise ImportError(
+                "anthropic package is required. Install with: pip install anthropic"
+            ) from None
+        anthropic = sdk
+
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ValueError(
+            "ANTHROPIC_API_KEY environment variable is required. "
+            "Set it with: set ANTHROPIC_API_KEY=your-key-here (Windows) "
+            "or export ANTHROPIC_API_KEY=your-key-here (Linux/Mac)"
+        )
+
+    with _client_lock:
+        if _shared_client is None or _shared_client_key != api_key:
+            options = {"api_key": api_key, "max_retries": API_MAX_RETRIES}
+            http_client = _http_client()
+            if http_client is not None:
+                options["http_client"] = http_client
+            _shared_client = anthropic.Anthropic(**options)
+            _shared_client_key = api_key
+        return _shared_client
+
+
+def _api_errors() -> tuple:
+    """
+    Return the exception types the Anthropic SDK raises for failed requests.
+
+    Empty while the SDK has not been imported, so an except clause using it
+    works even for a TeacherLLM whose client was supplied some other way.
+    """
+    return (anthropic.APIError,) if anthropic is not None else ()
+
+
+def _http_client():
+    """
+    Build the pooled HTTP client used by get_client().
+
+    Keeps up to 20 idle connections alive and fails fast on connect; the
+    SDK's long read timeout is kept, since a batch response can take minutes
+    to generate. HTTP/2 is only enabled when the h2 package is installed.
+
+    Returns:
+        An httpx client, or None to use the SDK's default client
+    """
+    try:
+        import httpx
+    except ImportError:
+        return None
+    try:
+        import h2  # noqa: F401  Optional: lets httpx multiplex over HTTP/2
+        http2 = True
+    except ImportError:
+        http2 = False
+    return anthropic.DefaultHttpxClient(
+        http2=http2,
+        timeout=httpx.Timeout(anthropic.DEFAULT_TIMEOUT.read, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+
+
+def close_client():
+    """Close the shared Anthropic client and its pooled connections, if any."""
+    global _shared_client, _shared_client_key
+    with _client_lock:
+        if _shared_client is not None:
+            _shared_client.close()
+        _shared_client = None
+        _shared_client_key = None
+
+
+# End of a generated rule: its "- **Why**:" line, once complete
+RULE_END_RE = re.compile(r"^- \*\*Why\*\*:.*\n", re.MULTILINE)
+
+
+def _cache_get(key: str) -> Optional[str]:
+    """Look up a cached response, marking it most recently used."""
+    with _cache_lock:
+        text = _RESPONSE_CACHE.get(key)
+        if text is not None:
+            _RESPONSE_CACHE.move_to_end(key)
+        return text
+
+
+def _cache_put(key: str, text: str):
+    """Cache a response, evicting the least recently used beyond the limit."""
+    with _cache_lock:
+        _RESPONSE_CACHE[key] = text
+        if len(_RESPONSE_CACHE) > _RESPONSE_CACHE_SIZE:
+            _RESPONSE_CACHE.popitem(last=False)
+
+
+def _count(stat: str):
+    """Increment a cache statistic."""
+    with _cache_lock:
+        _CACHE_STATS[stat] += 1
+
+
+def _literal_automaton(patterns: List[Tuple[str, str]]):
+    """
+    Build an Aho-Corasick automaton over the plain-literal error patterns.
+
+    Each literal maps to its priority (index in patterns). Returns None if
+    pyahocorasick is not installed.
+    """
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for priority, (pattern, _) in enumerate(patterns):
+        if re.escape(pattern) == pattern:
+            automaton.add_word(pattern.lower(), priority)
+    automaton.make_automaton()
+    return automaton
+
+
+# File header lines that carry no information for the Teacher ("+++ b/path"
+# names the file); only matched between "diff --git" and the file's first hunk
+_DIFF_BOILERPLATE_RE = re.compile(
+    r"^(?:diff --git |index |--- |new file mode |deleted file mode |similarity index )"
+)
+_HUNK_HEADER_RE = re.compile(r"^@@ [^@]* @@ ?")
+# Old and new line counts of a hunk ("@@ -12,5 +12,6 @@"); omitted counts are 1
+_HUNK_RANGE_RE = re.compile(r"^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@")
+# Interpreter/site-packages prefix of traceback paths
+_SITE_PACKAGES_RE = re.compile(r'(File ")[^"]*?[/\\](?:site|dist)-packages[/\\]')
+
+
+def _parse_diff(diff: str) -> List[list]:
+    """
+    Split a git diff into files and compressed hunks.
+
+    Returns [header lines, hunks] per file, each hunk being [lines, old lines
+    missing, new lines missing]; the counts stay above 0 for a hunk cut off
+    before its end. Header lines are what is left of the file header once
+    boilerplate is dropped ("+++ b/path", "Binary files ... differ").
+    Hunk positions are dropped too; the function name git appends to the
+    hunk header is kept. Text before the first "diff --git" line is kept as
+    one hunk, and a file without hunks gets one empty hunk.
+    """
+    files = []
+    # True between a "diff --git" line and the file's first hunk; hunk lines
+    # such as a removed "-- comment" or an added "++ x" are never header lines
+    in_header = False
+    for line in diff.rstrip("\n").split("\n"):
+        if line.startswith("diff --git "):
+            files.append([[], []])
+            in_header = True
+            continue
+        if not files:
+            files.append([[], [[[], 0, 0]]])
+        header, hunks = files[-1]
+        if line.startswith("@@"):
+            in_header = False
+            match = _HUNK_RANGE_RE.match(line)
+            old, new = (int(match.group(1) or 1), int(match.group(2) or 1)) if match else (0, 0)
+            hunks.append([[("@@ " + _HUNK_HEADER_RE.sub("", line)).rstrip()], old, new])
+        elif in_header:
+            if not _DIFF_BOILERPLATE_RE.match(line):
+                header.append(line.rstrip())
+        else:
+            hunk = hunks[-1]
+            hunk[0].append(line.rstrip())
+            if line[:1] in ("", " ", "-"):
+                hunk[1] -= 1
+            if line[:1] in ("", " ", "+"):
+                hunk[2] -= 1
+    for _, hunks in files:
+        if not hunks:
+            hunks.append([[], 0, 0])
+    return files
+
+
+def _render_diff(files: List[list], keep=None) -> str:
+    """Join parsed files back into text, limited to the (file, hunk) pairs in keep."""
+    lines = []
+    for f, (header, hunks) in enumerate(files):
+        chosen = [hunk for h, hunk in enumerate(hunks) if keep is None or (f, h) in keep]
+        if chosen:
+            lines.extend(header)
+            for hunk_lines, _, _ in chosen:
+                lines.extend(hunk_lines)
+    return "\n".join(lines)
+
+
+def _select_hunks(diff: str, budget: int) -> str:
+    """
+    Compress a git diff and fit it into budget characters, keeping whole hunks.
+
+    A hunk cut off by an earlier size limit is dropped. If the rest is still
+    too long, hunks with the most changed lines are kept first and printed in
+    their original order under their file's header. Falls back to a plain
+    prefix if not even one hunk fits.
+    """
+    files = _parse_diff(diff)
+    units = {(f, h) for f, (_, hunks) in enumerate(files) for h in range(len(hunks))}
+    complete = {
+        (f, h) for f, h in units
+        if files[f][1][h][1] <= 0 and files[f][1][h][2] <= 0
+    }
+    if complete:
+        units = complete
+    text = _render_diff(files, units)
+    if len(text) <= budget:
+        return text
+
+    def changed(unit):
+        lines = files[unit[0]][1][unit[1]][0]
+        return sum(1 for line in lines[1:] if line[:1] in ("+", "-"))
+
+    # Leave room for the note on omitted hunks
+    room = budget - 40
+    chosen, chosen_files, used = set(), set(), 0
+    for unit in sorted(units, key=lambda unit: (-changed(unit), unit)):
+        f, h = unit
+        header, hunks = files[f]
+        cost = len("\n".join(hunks[h][0])) + 1
+        if f not in chosen_files:
+            cost += sum(len(line) + 1 for line in header)
+        if used + cost <= room:
+            chosen.add(unit)
+            chosen_files.add(f)
+            used += cost
+    if not chosen:
+        return _clip(text, budget)
+
+    text = _render_diff(files, chosen)
+    if len(chosen) < len(units):
+        text += f"\n[{len(units) - len(chosen)} hunk(s) with fewer changes omitted]"
+    return text
+
+
+def _compress_errors(errors: str) -> str:
+    """
+    Shorten an error log without losing its failure details.
+
+    Runs of identical lines or identical two-line traceback frames (deep
+    recursion) are collapsed, site-packages path prefixes are shortened and
+    blank lines are squeezed.
+    """
+    errors = _SITE_PACKAGES_RE.sub(r"\1.../site-packages/", errors)
+    lines = [line.rstrip() for line in errors.splitlines()]
+
+    out = []
+    i = 0
+    while i < len(lines):
+        for size in (1, 2):
+            block = lines[i:i + size]
+            repeats = 1
+            while lines[i + repeats * size:i + (repeats + 1) * size] == block:
+                repeats += 1
+            if repeats > 2 and len(block) == size and any(block):
+                out.extend(block)
+                out.append(f"[previous {size} line(s) repeated {repeats - 1} more times]")
+                i += repeats * size
+                break
+        else:
+            if lines[i] or (out and out[-1]):
+                out.append(lines[i])
+            i += 1
+    return "\n".join(out)
+
+
+def _clip(text: Union[str, bytes, None], limit: int) -> str:
+    """
+    Return at most limit characters of text.
+
+    Bytes are decoded only up to limit bytes, so a large subprocess output is
+    never decoded in full just to be cut down afterwards.
+    """
+    if not text:
+        return ""
+    if isinstance(text, bytes):
+        return text[:limit].decode("utf-8", errors="replace")
+    # Slicing a str that is already short enough returns it without a copy
+    return text[:limit]
 
 
 class TeacherLLM:
@@ -32,6 +376,8 @@ class TeacherLLM:
     """
 
     DEFAULT_MODEL = "claude-3-5-haiku-20241022"
+    # Rule generation fills a rigid template, so a small model is enough
+    DEFAULT_RULE_MODEL = "claude-3-5-haiku-20241022"
 
     # ============ SYSTEM PROMPTS ============
 
@@ -70,6 +416,63 @@ Example output:
 
 IMPORTANT: Output ONLY the rule in the format above. No additional text or explanation."""
 
+    # Appended to the analysis prompt when several failures are sent at once
+    BATCH_OUTPUT_INSTRUCTIONS = """
+
+You will be given several failures, numbered from 1. For EACH failure, analyze
+its root cause and write a SINGLE preventive rule for the developer's
+CLAUDE.md file in this EXACT format (including the markdown formatting):
+
+### [Short Category Name]
+- **Rule**: [Clear instruction in imperative form]
+- **When**: [Context when this rule applies]
+- **Why**: [Brief explanation]
+
+Respond with ONLY a JSON array holding one object per failure, in order, and
+no other text:
+[{"analysis": "<root cause analysis>", "rule": "<the rule in the format above>"}]"""
+
+    # From this many cases on, analyze_failures_batch uses the Message Batches
+    # API (half price, processed in parallel); its status is polled this often
+    BATCH_API_MIN_CASES = 50
+    BATCH_POLL_SECONDS = 10
+
+    # Output limits for the two-call pipeline, sized to the concise outputs
+    # the prompts ask for; a truncated response is retried once with double
+    ROOT_CAUSE_MAX_TOKENS = 400
+    RULE_MAX_TOKENS = 150
+    # Output cap of the default models; a request asking for more is rejected
+    MAX_OUTPUT_TOKENS = 8192
+
+    # Sampling temperature for every request; 0 keeps cached responses valid
+    TEMPERATURE = 0
+
+    # Input limits for the analysis prompt
+    MAX_DIFF_CHARS = 8000
+    MAX_ERROR_CHARS = 4000
+    COMPRESS_INPUT_FACTOR = 4
+
+    # Failure types reported with a context/description instead of a diff
+    CONTEXT_FAILURE_TYPES = frozenset([
+        "planning_error", "integration_error", "workflow_error",
+        "architecture_error", "scope_error", "config_error"
+    ])
+
+    # Appended to an analysis prompt so one call returns analysis and rule
+    FUSED_OUTPUT_INSTRUCTIONS = """
+
+Then write a SINGLE preventive rule for the developer's CLAUDE.md file that is
+actionable, specific, and prevents this exact type of error, in this EXACT
+format (including the markdown formatting):
+
+### [Short Category Name]
+- **Rule**: [Clear instruction in imperative form]
+- **When**: [Context when this rule applies]
+- **Why**: [Brief explanation]
+
+Respond with ONLY a JSON object and no other text:
+{"analysis": "<your root cause analysis>", "rule": "<the rule in the format above>"}"""
+
     # ============ DOMAIN-SPECIFIC PROMPTS ============
 
     # For planning errors (wrong approach, misunderstood requirements)
@@ -172,30 +575,54 @@ Focus on architectural principles and patterns."""
         "other": ROOT_CAUSE_SYSTEM,  # Default to test failure prompt
     }
 
-    def __init__(self, model: str = None, max_tokens: int = 1024):
+    # failure type -> (system prompt, uses the context/description format),
+    # so prompt selection is a single lookup
+    _PROMPT_DISPATCH = {}
+    for _type, _prompt in FAILURE_TYPE_PROMPTS.items():
+        _PROMPT_DISPATCH[_type] = (_prompt, _type in CONTEXT_FAILURE_TYPES)
+    del _type, _prompt
+
+    def __init__(self, model: str = None, max_tokens: int = 600,
+                 cache_dir: Optional[str] = None, rule_model: str = None):
         """
         Initialize the Teacher LLM.
 
         Args:
-            model: Anthropic model to use (default: claude-3-5-sonnet-20241022)
-            max_tokens: Maximum tokens for responses
+            model: Anthropic model for root cause analysis, including the
+                combined analysis + rule call (default: claude-3-5-haiku-20241022)
+            max_tokens: Maximum tokens for a combined analysis + rule response
+            cache_dir: Directory for responses cached across runs (None disables)
+            rule_model: Model for the separate generate_rule() step
+                (default: claude-3-5-haiku-20241022)
         """
-        if anthropic is None:
-            raise ImportError(
-                "anthropic package is required. Install with: pip install anthropic"
-            )
-
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-        if not api_key:
-            raise ValueError(
-                "ANTHROPIC_API_KEY environment variable is required. "
-                "Set it with: set ANTHROPIC_API_KEY=your-key-here (Windows) "
-                "or export ANTHROPIC_API_KEY=your-key-here (Linux/Mac)"
-            )
-
-        self.client = anthropic.Anthropic(api_key=api_key)
+        # Fails early if the SDK or API key is missing; requests look the
+        # shared client up again (see client) so close() never strands them
+        get_client()
+        self._client = None
         self.model = model or self.DEFAULT_MODEL
+        self.rule_model = rule_model or self.DEFAULT_RULE_MODEL
         self.max_tokens = max_tokens
+        self.cache_dir = Path(cache_dir).expanduser() if cache_dir else None
+
+    @property
+    def client(self) -> "anthropic.Anthropic":
+        """The shared client from get_client(), unless one was assigned."""
+        if self._client is not None:
+            return self._client
+        return get_client()
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    def close(self):
+        """
+        Release the HTTP connections held for Teacher requests.
+
+        The client is shared by all TeacherLLM instances; any instance still
+        in use gets a new one from get_client() on its next request.
+        """
+        close_client()
 
     def analyze_root_cause(self, diff: str, errors: str, task: str,
                            failure_type: str = "test_failure") -> str:
@@ -211,48 +638,134 @@ Focus on architectural principles and patterns."""
         Returns:
             Root cause analysis as a string
         """
-        # Select appropriate system prompt based on failure type
-        system_prompt = self.FAILURE_TYPE_PROMPTS.get(
-            failure_type, self.ROOT_CAUSE_SYSTEM
+        system_prompt, user_message = self._build_root_cause_request(
+            diff, errors, task, failure_type
+        )
+        return self._cached_messages_create(
+            system_prompt, user_message, min(self.max_tokens, self.ROOT_CAUSE_MAX_TOKENS)
         )
 
-        # Format user message based on failure type
-        if failure_type in ["planning_error", "integration_error", "workflow_error",
-                          "architecture_error", "scope_error", "config_error"]:
-            # Non-test failures use context/description format
-            user_message = f"""## Task Description
-{task}
+    # Root cause user messages as the (head, middle, tail, foot) text placed
+    # around the task, diff and errors; joined in _build_root_cause_request
+    _TEST_MESSAGE = (
+        "## Task Description\n",
+        "\n\n## Code Diff\n```\n",
+        "\n```\n\n## Error Logs\n```\n",
+        "\n```\n\nAnalyze the root cause of this test failure.",
+    )
+    _CONTEXT_MESSAGE = (
+        "## Task Description\n",
+        "\n\n",
+        "\n\n",
+        "\n\nAnalyze the root cause of this failure.",
+    )
+
+    # Changes whenever a prompt or message template is edited, so failure
+    # signatures (and the cached results stored under them) expire with it
+    _PROMPT_VERSION = hashlib.sha256("\0".join([
+        ROOT_CAUSE_SYSTEM, RULE_GENERATOR_SYSTEM, FUSED_OUTPUT_INSTRUCTIONS,
+        BATCH_OUTPUT_INSTRUCTIONS, *FAILURE_TYPE_PROMPTS.values(),
+        *_TEST_MESSAGE, *_CONTEXT_MESSAGE,
+    ]).encode("utf-8")).hexdigest()[:16]
+
+    def _build_root_cause_request(self, diff: Union[str, bytes],
+                                  errors: Union[str, bytes], task: str,
+                                  failure_type: str) -> Tuple[str, str]:
+        """
+        Return the (system prompt, user message) pair for root cause analysis.
 
-{diff[:8000] if diff else "No context available"}
+        diff and errors may be str or raw subprocess bytes; they are clipped
+        to MAX_DIFF_CHARS / MAX_ERROR_CHARS before being formatted.
+        """
+        # Select appropriate system prompt based on failure type
+        system_prompt, context_format = self._PROMPT_DISPATCH.get(
+            failure_type, (self.ROOT_CAUSE_SYSTEM, False)
+        )
 
-{errors[:4000] if errors else "No failure description available"}
+        # Compress first so more of the failure fits within the limits; at most
+        # COMPRESS_INPUT_FACTOR times the limit is decoded and compressed. A
+        # diff still too long keeps its most-changed hunks whole. Context for
+        # non-test failures is free text, not a diff, and is only clipped.
+        if context_format:
+            diff = _clip(diff, self.MAX_DIFF_CHARS)
+        else:
+            diff = _select_hunks(
+                _clip(diff, self.MAX_DIFF_CHARS * self.COMPRESS_INPUT_FACTOR),
+                self.MAX_DIFF_CHARS
+            )
+        errors = _clip(
+            _compress_errors(_clip(errors, self.MAX_ERROR_CHARS * self.COMPRESS_INPUT_FACTOR)),
+            self.MAX_ERROR_CHARS
+        )
 
-Analyze the root cause of this failure."""
+        # Fill the user message template for the failure type
+        if context_format:
+            # Non-test failures use context/description format
+            head, middle, tail, foot = self._CONTEXT_MESSAGE
+            no_diff, no_errors = "No context available", "No failure description available"
         else:
             # Test failures use diff/error log format
-            user_message = f"""## Task Description
-{task}
-
-## Code Diff
-```
-{diff[:8000] if diff else "No diff available"}
-```
-
-## Error Logs
-```
-{errors[:4000] if errors else "No error logs available"}
-```
-
-Analyze the root cause of this test failure."""
-
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=self.max_tokens,
-            system=system_prompt,
-            messages=[{"role": "user", "content": user_message}]
+            head, middle, tail, foot = self._TEST_MESSAGE
+            no_diff, no_errors = "No diff available", "No error logs available"
+        user_message = "".join(
+            [head, task, middle, diff or no_diff, tail, errors or no_errors, foot]
         )
 
-        return response.content[0].text
+        return system_prompt, user_message
+
+    def analyze_and_generate(self, diff: str, errors: str, task: str,
+                             failure_type: str = "test_failure") -> dict:
+        """
+        Analyze the root cause and generate the rule in a single API call.
+
+        The model is asked for a JSON object with both parts. If the response
+        cannot be parsed, its text is taken as the analysis and the rule is
+        generated separately (generate_rule); an empty response falls back
+        to the full two-call pipeline.
+
+        Args:
+            diff: Git diff or context information
+            errors: Test error output or failure description
+            task: Original task description
+            failure_type: Type of failure (determines which prompt to use)
+
+        Returns:
+            dict with keys: analysis, rule
+        """
+        system_prompt, user_message = self._build_root_cause_request(
+            diff, errors, task, failure_type
+        )
+        text = self._cached_messages_create(
+            system_prompt + self.FUSED_OUTPUT_INSTRUCTIONS, user_message, self.max_tokens
+        )
+
+        result = self._parse_fused_response(text)
+        if result is not None:
+            return result
+
+        # Not JSON, but usually still a usable analysis: only the rule step
+        # needs another call
+        analysis = text.strip() or self.analyze_root_cause(diff, errors, task, failure_type)
+        return {"analysis": analysis, "rule": self.generate_rule(analysis)}
+
+    @staticmethod
+    def _parse_fused_response(text: str) -> Optional[dict]:
+        """Extract {analysis, rule} from a JSON reply, tolerating code fences."""
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end < start:
+            return None
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError:
+            return None
+        return TeacherLLM._fused_entry(data)
+
+    @staticmethod
+    def _fused_entry(data) -> Optional[dict]:
+        """Validate one decoded {analysis, rule} object."""
+        if not isinstance(data, dict) or not data.get("analysis") or not data.get("rule"):
+            return None
+        return {"analysis": str(data["analysis"]), "rule": str(data["rule"]).strip()}
 
     def generate_rule(self, root_cause_analysis: str) -> str:
         """
@@ -270,19 +783,169 @@ Analyze the root cause of this test failure."""
 
 Remember: Output ONLY the rule in the exact format specified. No additional text."""
 
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=512,
-            system=self.RULE_GENERATOR_SYSTEM,
-            messages=[{"role": "user", "content": user_message}]
-        )
+        # The rule ends with its "- **Why**:" line; stop streaming there
+        return self._cached_messages_create(
+            self.RULE_GENERATOR_SYSTEM, user_message, self.RULE_MAX_TOKENS,
+            stop_at=RULE_END_RE, model=self.rule_model
+        ).strip()
 
-        return response.content[0].text.strip()
+    def _cached_messages_create(self, system: str, user_message: str,
+                                max_tokens: int,
+                                stop_at: Optional[re.Pattern] = None,
+                                model: Optional[str] = None) -> str:
+        """
+        Call messages.create and return the response text.
+
+        model defaults to self.model. Identical requests (same model,
+        max_tokens, system prompt and message) are answered from an in-process
+        cache, then from cache_dir if set, instead of calling the API.
+        Requests use temperature 0 so a cached response is the one the API
+        would most likely give again.
+
+        With stop_at, the response is streamed and cut off at the end of the
+        first match of that pattern, so no tokens are generated past the
+        useful output.
+        """
+        model = model or self.model
+        key = hashlib.sha256(
+            "\0".join([model, str(max_tokens), str(self.TEMPERATURE),
+                       system, user_message]).encode("utf-8")
+        ).hexdigest()
+
+        cached = _cache_get(key)
+        if cached is not None:
+            _count("hits")
+            return cached
+
+        text = self._read_disk_cache(key)
+        if text is not None:
+            _count("disk_hits")
+        else:
+            _count("misses")
+            params = {
+                "model": model,
+                "max_tokens": max_tokens,
+                "temperature": self.TEMPERATURE,
+                "system": system,
+                "messages": [{"role": "user", "content": user_message}]
+            }
+            text, truncated = self._request_text(params, stop_at)
+            if truncated and max_tokens < self.MAX_OUTPUT_TOKENS:
+                # Limits are tight on purpose; pay for more only when needed
+                params["max_tokens"] = min(max_tokens * 2, self.MAX_OUTPUT_TOKENS)
+                print(f"  [WARN] Teacher response hit max_tokens={max_tokens}, "
+                      f"retrying with {params['max_tokens']}")
+                text, _ = self._request_text(params, stop_at)
+            if not text.strip():
+                # An empty reply is not worth keeping; ask again next time
+                return text
+            self._write_disk_cache(key, text)
+
+        _cache_put(key, text)
+        return text
+
+    def _request_text(self, params: dict,
+                      stop_at: Optional[re.Pattern]) -> Tuple[str, bool]:
+        """
+        Send one request; return its text and whether max_tokens cut it short.
+
+        With stop_at the response is streamed and cut at the first match.
+        """
+        if stop_at is None:
+            response = self.client.messages.create(**params)
+            return response.content[0].text, response.stop_reason == "max_tokens"
+
+        text = ""
+        with self.client.messages.stream(**params) as stream:
+            for chunk in stream.text_stream:
+                text += chunk
+                match = stop_at.search(text)
+                if match:
+                    return text[:match.end()], False
+            return text, stream.get_final_message().stop_reason == "max_tokens"
+
+    def _failure_signature(self, diff: Union[str, bytes], errors: Union[str, bytes],
+                           task: str) -> str:
+        """
+        Hash a failure with its run-specific noise removed.
+
+        Failures of the same mistake often differ only in line numbers, blob
+        ids, addresses or timings, which would defeat the exact request cache.
+        The models and prompt version are part of the hash, so a result is
+        only reused for the same requests.
+        """
+        diff = _clip(diff, self.MAX_DIFF_CHARS)
+        errors = _clip(errors, self.MAX_ERROR_CHARS)
+        for pattern, replacement in _DIFF_NOISE:
+            diff = pattern.sub(replacement, diff)
+        for pattern, replacement in _ERROR_NOISE:
+            errors = pattern.sub(replacement, errors)
+        return "similar-" + hashlib.sha256(
+            "\0".join([self.model, self.rule_model, self._PROMPT_VERSION,
+                        task, diff, errors]).encode("utf-8")
+        ).hexdigest()
+
+    def _similar_get(self, signature: str) -> Optional[dict]:
+        """Return the stored {analysis, rule} for a failure signature, if any."""
+        text = _cache_get(signature) or self._read_disk_cache(signature)
+        if text is None:
+            return None
+        try:
+            result = json.loads(text)
+        except ValueError:
+            return None
+        if not result.get("rule"):
+            return None
+        _count("similar_hits")
+        return {"analysis": result["analysis"], "rule": result["rule"]}
+
+    def _similar_put(self, signature: str, result: dict):
+        """
+        Store {analysis, rule} under a failure signature.
+
+        Results without a rule are not stored, so the failure is analyzed
+        again next time instead of never teaching a rule.
+        """
+        if not result["rule"]:
+            return
+        text = json.dumps({"analysis": result["analysis"], "rule": result["rule"]})
+        _cache_put(signature, text)
+        self._write_disk_cache(signature, text)
+
+    def _read_disk_cache(self, key: str) -> Optional[str]:
+        """Return the response stored under key in cache_dir, if any."""
+        if self.cache_dir is None:
+            return None
+        try:
+            return json.loads((self.cache_dir / f"{key}.json").read_text())["text"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_disk_cache(self, key: str, text: str):
+        """Store a response in cache_dir (atomically, so readers never see a partial file)."""
+        if self.cache_dir is None:
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"text": text, "ts": time.time()}, f)
+            os.replace(tmp, self.cache_dir / f"{key}.json")
+        except OSError:
+            pass  # The cache is an optimization; never fail the analysis over it
+
+    @staticmethod
+    def cache_stats() -> dict:
+        """Return response cache hit counts (in-process and disk) and misses."""
+        return dict(_CACHE_STATS)
 
     def analyze_failure(self, diff: str, errors: str, task: str) -> dict:
         """
         Full analysis pipeline: root cause + rule generation.
 
+        Both are produced by a single API call (see analyze_and_generate),
+        unless a failure with the same _failure_signature was analyzed before.
+
         Args:
             diff: Git diff showing code changes
             errors: Test error output
@@ -292,11 +955,15 @@ Remember: Output ONLY the rule in the exact format specified. No additional text
             dict with keys: analysis, rule, error_type
         """
         try:
-            # Step 1: Root cause analysis
-            analysis = self.analyze_root_cause(diff, errors, task)
-
-            # Step 2: Generate rule
-            rule = self.generate_rule(analysis)
+            # Reuse the result for a failure that differs only in run-specific
+            # details (line numbers, blob ids, timings)
+            signature = self._failure_signature(diff, errors, task)
+            result = self._similar_get(signature)
+            if result is None:
+                # Root cause analysis and rule generation in one call
+                result = self.analyze_and_generate(diff, errors, task)
+                self._similar_put(signature, result)
+            analysis, rule = result["analysis"], result["rule"]
 
             # Extract error type from analysis (simple heuristic)
             error_type = self._extract_error_type(analysis, errors)
@@ -307,7 +974,7 @@ Remember: Output ONLY the rule in the exact format specified. No additional text
                 "error_type": error_type
             }
 
-        except anthropic.APIError as e:
+        except _api_errors() as e:
             return {
                 "analysis": f"API error: {e}",
                 "rule": "",
@@ -320,42 +987,272 @@ Remember: Output ONLY the rule in the exact format specified. No additional text
                 "error_type": "analysis_error"
             }
 
+    def analyze_failures_batch(self, cases: List[dict]) -> List[dict]:
+        """
+        Analyze several test failures and generate their rules in one API call.
+
+        Falls back to one analyze_failure call per case if the reply cannot be
+        parsed into exactly one result per case. More cases than fit in
+        MAX_OUTPUT_TOKENS are split over several calls. From
+        BATCH_API_MIN_CASES cases on, the Message Batches API is used instead
+        (see analyze_failures_bulk). Cases with the same _failure_signature
+        are sent once and share the result.
+
+        Args:
+            cases: dicts with keys diff, errors, task
+
+        Returns:
+            One dict per case, in order, with keys: analysis, rule, error_type
+        """
+        if len(cases) == 1:
+            return [self.analyze_failure(**cases[0])]
+
+        # Failures that differ only in run-specific details (typically the
+        # same assertion hit by several attempts) are analyzed once
+        unique, owners = self._group_similar(cases)
+        if len(unique) < len(cases):
+            print(f"  [OK] {len(cases)} failures reduce to {len(unique)} distinct failure(s)")
+            results = self.analyze_failures_batch(unique)
+            return [dict(results[i]) for i in owners]
+
+        if len(cases) >= self.BATCH_API_MIN_CASES:
+            return self.analyze_failures_bulk(cases)
+
+        # Every case needs max_tokens of output; split the cases into calls
+        # whose combined budget stays within the model's output cap
+        per_call = max(1, self.MAX_OUTPUT_TOKENS // self.max_tokens)
+        if len(cases) > per_call:
+            results = []
+            for start in range(0, len(cases), per_call):
+                results.extend(self.analyze_failures_batch(cases[start:start + per_call]))
+            return results
+
+        parts = []
+        for i, case in enumerate(cases, 1):
+            _, user_message = self._build_root_cause_request(
+                case["diff"], case["errors"], case["task"], "test_failure"
+            )
+            parts.append(f"# Failure {i}\n\n{user_message}")
+
+        try:
+            text = self._cached_messages_create(
+                self.ROOT_CAUSE_SYSTEM + self.BATCH_OUTPUT_INSTRUCTIONS,
+                "\n\n".join(parts),
+                self.max_tokens * len(cases)
+            )
+            results = self._parse_batch_response(text, len(cases))
+        except _api_errors():
+            results = None
+
+        if results is None:
+            return self.analyze_failures_many(cases)
+
+        for result, case in zip(results, cases):
+            result["error_type"] = self._extract_error_type(result["analysis"], case["errors"])
+        return results
+
+    def _group_similar(self, cases: List[dict]) -> Tuple[List[dict], List[int]]:
+        """
+        Group cases by _failure_signature.
+
+        Returns:
+            (one representative case per group, index of each case's group)
+        """
+        groups = {}
+        unique, owners = [], []
+        for case in cases:
+            signature = self._failure_signature(case["diff"], case["errors"], case["task"])
+            if signature not in groups:
+                groups[signature] = len(unique)
+                unique.append(case)
+            owners.append(groups[signature])
+        return unique, owners
+
+    @staticmethod
+    def _parse_batch_response(text: str, count: int) -> Optional[List[dict]]:
+        """Extract a list of count {analysis, rule} objects from a JSON reply."""
+        start, end = text.find("["), text.rfind("]")
+        if start == -1 or end < start:
+            return None
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError:
+            return None
+
+        if not isinstance(data, list) or len(data) != count:
+            return None
+        results = [TeacherLLM._fused_entry(item) for item in data]
+        return None if None in results else results
+
+    def analyze_failures_bulk(self, cases: List[dict],
+                              timeout: float = 3600) -> List[dict]:
+        """
+        Analyze many failures through the Message Batches API.
+
+        Each case becomes one combined analysis + rule request. Batched requests
+        cost half as much and are processed in parallel, but may take minutes.
+        Cases whose request fails or cannot be parsed, or all of them if the
+        batch has not ended within timeout seconds, go through analyze_failure.
+
+        Args:
+            cases: dicts with keys diff, errors, task
+            timeout: Seconds to wait for the batch before cancelling it
+
+        Returns:
+            One dict per case, in order, with keys: analysis, rule, error_type
+        """
+        requests = []
+        for i, case in enumerate(cases):
+            system_prompt, user_message = self._build_root_cause_request(
+                case["diff"], case["errors"], case["task"], "test_failure"
+            )
+            requests.append({
+                "custom_id": f"case-{i}",
+                "params": {
+                    "model": self.model,
+                    "max_tokens": self.max_tokens,
+                    "temperature": self.TEMPERATURE,
+                    "system": system_prompt + self.FUSED_OUTPUT_INSTRUCTIONS,
+                    "messages": [{"role": "user", "content": user_message}]
+                }
+            })
+
+        results: List[Optional[dict]] = [None] * len(cases)
+        try:
+            batches = self.client.messages.batches
+            batch = batches.create(requests=requests)
+            deadline = time.monotonic() + timeout
+            while batch.processing_status != "ended":
+                if time.monotonic() >= deadline:
+                    batches.cancel(batch.id)
+                    break
+                time.sleep(self.BATCH_POLL_SECONDS)
+                batch = batches.retrieve(batch.id)
+            else:
+                # Results arrive in any order; custom_id gives the case index
+                for entry in batches.results(batch.id):
+                    if entry.result.type == "succeeded":
+                        index = int(entry.custom_id.rsplit("-", 1)[1])
+                        results[index] = self._parse_fused_response(
+                            entry.result.message.content[0].text
+                        )
+        except _api_errors() as e:
+            print(f"  [WARN] Message batch failed ({e}), analyzing one by one")
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        retried = self.analyze_failures_many([cases[i] for i in missing])
+        for i, result in zip(missing, retried):
+            results[i] = result
+
+        for i, case in enumerate(cases):
+            if i not in missing:
+                results[i]["error_type"] = self._extract_error_type(
+                    results[i]["analysis"], case["errors"]
+                )
+        return results
+
+    def analyze_failures_many(self, cases: List[dict],
+                              concurrency: int = 8) -> List[dict]:
+        """
+        Analyze independent failures concurrently, one analyze_failure call each.
+
+        The calls are network-bound, so worker threads sharing the client's
+        connection pool overlap their round trips.
+
+        Args:
+            cases: dicts with keys diff, errors, task
+            concurrency: Maximum requests in flight
+
+        Returns:
+            One dict per case, in order, with keys: analysis, rule, error_type
+        """
+        if len(cases) <= 1:
+            return [self.analyze_failure(**case) for case in cases]
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(cases))) as pool:
+            return list(pool.map(lambda case: self.analyze_failure(**case), cases))
+
+    # (pattern, label) in priority order: the first listed pattern that
+    # matches anywhere in the text wins
+    ERROR_PATTERNS = [
+        # Python exceptions
+        (r"TypeError", "type_error"),
+        (r"ValueError", "value_error"),
+        (r"AttributeError", "attribute_error"),
+        (r"KeyError", "key_error"),
+        (r"IndexError", "index_error"),
+        (r"ImportError", "import_error"),
+        (r"NameError", "name_error"),
+        (r"ZeroDivisionError", "division_error"),
+        (r"AssertionError", "assertion_error"),
+        (r"SyntaxError", "syntax_error"),
+        (r"RuntimeError", "runtime_error"),
+
+        # Planning/process failures
+        (r"misunderstood|wrong approach|should have", "planning_error"),
+        (r"redundant|duplicate|already exists", "integration_error"),
+        (r"scope.*creep|over-engineered|too complex", "scope_error"),
+
+        # Workflow/n8n failures
+        (r"n8n|workflow.*design|node.*wrong", "workflow_error"),
+        (r"credential|authentication.*missing|config", "config_error"),
+
+        # Architecture failures
+        (r"pattern.*wrong|architecture.*mismatch|design.*error", "architecture_error"),
+    ]
+
+    # All patterns in one alternation, each wrapped in a lookahead so a long
+    # match never hides a higher-priority pattern starting inside it
+    _ERROR_RE = re.compile(
+        "|".join(f"(?=(?P<{label}>{pattern}))" for pattern, label in ERROR_PATTERNS),
+        re.IGNORECASE
+    )
+    _ERROR_PRIORITY = {label: i for i, (_, label) in enumerate(ERROR_PATTERNS)}
+
+    # With pyahocorasick, the literal exception names are found in one linear
+    # pass; the regex is only needed when none outranks the first real regex
+    _LITERAL_AUTOMATON = _literal_automaton(ERROR_PATTERNS)
+    _FIRST_REGEX_PRIORITY = next(
+        (i for i, (pattern, _) in enumerate(ERROR_PATTERNS) if re.escape(pattern) != pattern),
+        len(ERROR_PATTERNS)
+    )
+    # Without it, the same literals are checked with substring searches
+    _ERROR_LITERALS = tuple(
+        (pattern.lower(), label) for pattern, label in ERROR_PATTERNS[:_FIRST_REGEX_PRIORITY]
+    )
+
     def _extract_error_type(self, analysis: str, errors: str) -> str:
         """Extract a short error type label from the analysis or errors."""
-        # Common Python error patterns
-        error_patterns = [
-            # Python exceptions
-            (r"TypeError", "type_error"),
-            (r"ValueError", "value_error"),
-            (r"AttributeError", "attribute_error"),
-            (r"KeyError", "key_error"),
-            (r"IndexError", "index_error"),
-            (r"ImportError", "import_error"),
-            (r"NameError", "name_error"),
-            (r"ZeroDivisionError", "division_error"),
-            (r"AssertionError", "assertion_error"),
-            (r"SyntaxError", "syntax_error"),
-            (r"RuntimeError", "runtime_error"),
-
-            # Planning/process failures
-            (r"misunderstood|wrong approach|should have", "planning_error"),
-            (r"redundant|duplicate|already exists", "integration_error"),
-            (r"scope.*creep|over-engineered|too complex", "scope_error"),
-
-            # Workflow/n8n failures
-            (r"n8n|workflow.*design|node.*wrong", "workflow_error"),
-            (r"credential|authentication.*missing|config", "config_error"),
-
-            # Architecture failures
-            (r"pattern.*wrong|architecture.*mismatch|design.*error", "architecture_error"),
-        ]
-
-        combined = f"{analysis} {errors}"
-        for pattern, error_type in error_patterns:
-            if re.search(pattern, combined, re.IGNORECASE):
-                return error_type
-
-        return "test_failure"
+        # Scanned one after the other rather than joined into a new string
+        texts = (analysis or "", errors or "")
+
+        if self._LITERAL_AUTOMATON is not None:
+            literal = min(
+                (priority for text in texts
+                 for _, priority in self._LITERAL_AUTOMATON.iter(text.lower())),
+                default=None
+            )
+            if literal is not None and literal < self._FIRST_REGEX_PRIORITY:
+                return self.ERROR_PATTERNS[literal][1]
+        else:
+            # Literals are in priority order and all outrank the regexes
+            lowered = [text.lower() for text in texts]
+            for literal, label in self._ERROR_LITERALS:
+                if any(literal in text for text in lowered):
+                    return label
+
+        best = None
+        for text in texts:
+            for match in self._ERROR_RE.finditer(text):
+                priority = self._ERROR_PRIORITY[match.lastgroup]
+                if best is None or priority < best:
+                    best = priority
+                    if best == 0:
+                        # Nothing outranks the first pattern
+                        return self.ERROR_PATTERNS[0][1]
+        if best is None:
+            return "test_failure"
+        return self.ERROR_PATTERNS[best][1]
 
 
 def test_teacher():